@@ -0,0 +1,61 @@
+# run with    python bench_pywinpath.py [n_entries]
+"""Memory needed to hold many PATH snapshots: lists of strings as WinPath
+kept them before (registry values and normalized copies) vs. the
+interned EntryTable with array backed hives.
+"""
+import sys
+import tracemalloc
+
+from pywinpath import *
+
+
+def workload(n_entries, per_snapshot=2000, distinct_ratio=10):
+    """Registry values of n_entries / per_snapshot snapshots, drawn from a
+    pool of n_entries / distinct_ratio distinct directories"""
+    pool = ['C:\\Program Files\\Vendor%i\\Product%i\\bin' % (i % 97, i)
+            for i in range(max(n_entries // distinct_ratio, 1))]
+    snapshots = []
+    for snap in range(max(n_entries // per_snapshot, 1)):
+        entries = [pool[(snap * 7 + i * 13) % len(pool)] for i in range(per_snapshot)]
+        half = per_snapshot // 2
+        snapshots.append((stringify(entries[:half]), stringify(entries[half:])))
+    return snapshots
+
+
+def lists_of_strings(snapshots):
+    kept = []
+    for user, system in snapshots:
+        orig_user, orig_sys = listify(user), listify(system)
+        reg_user = [normpath(p, verbose=False) for p in orig_user]
+        reg_sys = [normpath(p, verbose=False) for p in orig_sys]
+        kept.append((orig_user, orig_sys, reg_user, reg_sys))
+    return kept
+
+
+def compact(snapshots):
+    table = EntryTable()
+    return [WinPath(backend=MemoryBackend(user=user, system=system), verbose=False, table=table)
+            for user, system in snapshots]
+
+
+def measure(build, snapshots):
+    tracemalloc.start()
+    kept = build(snapshots)
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return used
+
+
+def main(n_entries=100000):
+    snapshots = workload(n_entries)
+    print('%i snapshots with %i entries in total' % (len(snapshots), n_entries))
+    before = measure(lists_of_strings, snapshots)
+    after = measure(compact, snapshots)
+    print('lists of strings: %8.1f MiB' % (before / 2**20))
+    print('EntryTable/Hive:  %8.1f MiB' % (after / 2**20))
+    print('reduction:        %8.1f %%' % (100. * (before - after) / before))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
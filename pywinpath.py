@@ -7,12 +7,23 @@ __author__ = 'github.com/czamb'
 
 import os
 import sys
+import re
 import json
 import glob
-import msvcrt
+import fnmatch
+import ntpath
 import platform
-import winreg
+import shutil
+from array import array
 from collections import OrderedDict, namedtuple
+from collections.abc import MutableSequence
+
+try:
+    import msvcrt
+    import winreg
+except ImportError:
+    # Not on Windows, only usable with a stand-in backend, e.g. MemoryBackend
+    msvcrt = winreg = None
 
 
 try:
@@ -28,15 +39,17 @@ def time_str():
     return datetime.datetime.now().strftime("%Y-%m-%d_%Hh%Mm%Ss")
 
 
-def uniquefy(lst, verbose=False):
+def uniquefy(lst, verbose=False, key=None):
     """Make entries of a list unique by keeping only the first
-    occurrence of any item and preserve order"""
+    occurrence of any item and preserve order. With key, items
+    are compared by key(item) instead."""
     seen = set()
     uniq = []
     for el in lst:
-        if el not in seen:
+        k = el if key is None else key(el)
+        if k not in seen:
             uniq.append(el)
-            seen.add(el)
+            seen.add(k)
     if verbose:
         n_dupes = len(lst) - len(uniq)
         if n_dupes > 0:
@@ -49,12 +62,91 @@ def stringify(path_list):
 
 
 def listify(path_str):
-    """Convert path-string to list"""
-    return [p.strip() for p in path_str.split(';')]
+    """Convert path-string to list, empty entries (e.g. of a trailing ';') are dropped"""
+    return [p.strip() for p in path_str.split(';') if p.strip()]
+
+
+def header_line(header):
+    return '==== %s ====' % header
 
 
 def print_header(header):
-    print('==== %s ====' % header)
+    print(header_line(header))
+
+
+_ansi_console = None
+
+
+def ansi_console():
+    """Check once if the console understands ANSI escape sequences,
+    on Windows 10 try to switch on VT100 processing"""
+    global _ansi_console
+    if _ansi_console is None:
+        _ansi_console = os.name != 'nt'
+        if not _ansi_console:
+            try:
+                import ctypes
+                kernel32 = ctypes.windll.kernel32
+                handle = kernel32.GetStdHandle(-11)  # STD_OUTPUT_HANDLE
+                mode = ctypes.c_ulong()
+                if kernel32.GetConsoleMode(handle, ctypes.byref(mode)):
+                    # ENABLE_VIRTUAL_TERMINAL_PROCESSING
+                    _ansi_console = bool(kernel32.SetConsoleMode(handle, mode.value | 0x0004))
+            except (AttributeError, OSError):
+                pass
+    return _ansi_console
+
+
+def is_tty(stream=None):
+    stream = sys.stdout if stream is None else stream
+    try:
+        return stream.isatty()
+    except (AttributeError, ValueError):
+        return False
+
+
+def clear_screen():
+    """Clear the console without spawning cmd.exe for 'cls'"""
+    if not is_tty():
+        return
+    if colorama or ansi_console():
+        # colorama translates these into console API calls on old Windows
+        sys.stdout.write('\x1b[2J\x1b[H')
+    else:
+        sys.stdout.write('\n' * shutil.get_terminal_size().lines)
+    sys.stdout.flush()
+
+
+def render(lines, paged=True):
+    """Write lines to stdout with one write call per screen page.
+    Paging only happens on an interactive console, redirected
+    output is written in one go."""
+    stream = sys.stdout
+    if not lines:
+        return
+    if not paged or msvcrt is None or not is_tty(stream):
+        stream.write('\n'.join(lines) + '\n')
+        stream.flush()
+        return
+    width, height = shutil.get_terminal_size()
+    page_len = max(height - 1, 1)  # keep one line for the prompt
+    erase_prompt = ''
+    for start in range(0, len(lines), page_len):
+        page = erase_prompt + '\n'.join(lines[start:start + page_len]) + '\n'
+        if start + page_len >= len(lines):
+            stream.write(page)
+            stream.flush()
+            break
+        prompt = '-- %i/%i -- any key: next page, q: quit' % (start + page_len, len(lines))
+        prompt = prompt[:width - 1]
+        stream.write(page + prompt)
+        stream.flush()
+        key = msvcrt.getch()
+        erase_prompt = '\r' + ' ' * len(prompt) + '\r'
+        if key.lower() in (b'q', b'\x1b'):
+            stream.write(erase_prompt)
+            stream.flush()
+            break
 
 
 def stylify(style, text):
@@ -67,13 +159,358 @@ def stylify(style, text):
 
 def normpath(path, verbose=True):
     """Normalize for better duplicate detection"""
-    normalized = os.path.normcase(os.path.abspath(path))
+    if path.startswith('%'):
+        # Keep variables such as %ProgramFiles% instead of making them relative to the cwd
+        normalized = ntpath.normcase(ntpath.normpath(path))
+    else:
+        normalized = ntpath.normcase(ntpath.abspath(path))
     if verbose and path != normalized:
         print('Normalized %s' % path)
         print('        to %s' % normalized)
     return normalized
 
 
+class EntryTable():
+    """Interned PATH entries. Every distinct entry is stored once and
+    referred to by an integer ID, its casefolded key and its length are
+    computed once. Tables only grow, so IDs stay valid."""
+
+    def __init__(self):
+        self.entries = []
+        self.keys = []
+        self.lengths = array('I')
+        self.ids = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def intern(self, entry):
+        try:
+            return self.ids[entry]
+        except KeyError:
+            pass
+        entry = sys.intern(entry)
+        key = entry.casefold()
+        if key == entry:
+            key = entry  # normalized entries are lower case already, share them
+        idx = len(self.entries)
+        self.entries.append(entry)
+        self.keys.append(key)
+        self.lengths.append(len(entry))
+        self.ids[entry] = idx
+        return idx
+
+
+# Shared by all WinPath instances, so that snapshots store each entry once
+entry_table = EntryTable()
+
+
+class Hive(MutableSequence):
+    """A path variable as an array of entry IDs. Behaves like a list of
+    strings, comparisons between hives of the same table only compare IDs."""
+
+    def __init__(self, table, entries=(), ids=None):
+        self.table = table
+        if ids is None:
+            ids = array('I', map(table.intern, entries))
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        entries = self.table.entries
+        return (entries[i] for i in self.ids)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return Hive(self.table, ids=self.ids[idx])
+        return self.table.entries[self.ids[idx]]
+
+    def _ids_of(self, entries):
+        if isinstance(entries, Hive) and entries.table is self.table:
+            return entries.ids
+        return array('I', map(self.table.intern, entries))
+
+    def __setitem__(self, idx, value):
+        if isinstance(idx, slice):
+            self.ids[idx] = self._ids_of(value)
+        else:
+            self.ids[idx] = self.table.intern(value)
+
+    def __delitem__(self, idx):
+        del self.ids[idx]
+
+    def insert(self, idx, value):
+        self.ids.insert(idx, self.table.intern(value))
+
+    def __contains__(self, entry):
+        idx = self.table.ids.get(entry)
+        return idx is not None and idx in self.ids
+
+    def index(self, entry, *args):
+        idx = self.table.ids.get(entry)
+        if idx is None:
+            raise ValueError('%r is not in hive' % (entry,))
+        return self.ids.index(idx, *args)
+
+    def __add__(self, other):
+        return Hive(self.table, ids=self.ids + self._ids_of(other))
+
+    def __eq__(self, other):
+        if isinstance(other, Hive) and other.table is self.table:
+            return self.ids == other.ids
+        try:
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return 'Hive(%r)' % list(self)
+
+    def copy(self):
+        return Hive(self.table, ids=array('I', self.ids))
+
+    def keys(self):
+        """Casefolded entries for case-insensitive comparison"""
+        keys = self.table.keys
+        return [keys[i] for i in self.ids]
+
+    def filter(self, keep):
+        """New hive with the entry IDs for which keep(id) is true"""
+        return Hive(self.table, ids=array('I', filter(keep, self.ids)))
+
+    @property
+    def str_len(self):
+        """Length of the path string, without computing it"""
+        if not self.ids:
+            return 0
+        lengths = self.table.lengths
+        return sum(lengths[i] for i in self.ids) + len(self.ids) - 1
+
+
+env_var = re.compile(r'%([^%;]+)%')
+
+
+class PathResolver():
+    """Resolves PATH entries to the directory they point to, so that e.g.
+    C:\\prg\\foo, C:\\PROGRA~1\\foo and %ProgramFiles%\\foo count as the
+    same directory. Each entry is resolved once, call clear() after
+    changing the filesystem."""
+
+    def __init__(self):
+        self.cache = {}
+        self.environ = None
+
+    def clear(self):
+        self.cache.clear()
+        self.environ = None
+
+    def expand(self, path):
+        """Expand %VAR% like cmd.exe does, unknown variables are kept"""
+        if '%' not in path:
+            return path
+        if self.environ is None:
+            # variable names are case-insensitive, taken from os.environ once per clear()
+            self.environ = {k.upper(): v for k, v in os.environ.items()}
+        return env_var.sub(lambda m: self.environ.get(m.group(1).upper(), m.group(0)), path)
+
+    def identity(self, path):
+        """Return a hashable identity: the file ID of existing directories,
+        which also covers junctions, symlinks and 8.3 short names, or the
+        normalized real path otherwise"""
+        try:
+            return self.cache[path]
+        except KeyError:
+            pass
+        expanded = self.expand(path)
+        try:
+            st = os.stat(expanded)
+        except (OSError, ValueError):
+            st = None
+        if st is not None and st.st_ino:
+            ident = ('id', st.st_dev, st.st_ino)
+        else:
+            ident = ('path', os.path.normcase(os.path.realpath(expanded)), st is not None)
+        self.cache[path] = ident
+        return ident
+
+    def exists(self, path):
+        ident = self.identity(path)
+        return ident[0] == 'id' or ident[2]
+
+
+EditOp = namedtuple('EditOp', ['action', 'hive', 'select', 'arg'])
+EditOp.__new__.__defaults__ = (None,)
+# action: delete, move, insert or replace
+# hive: user, system or both
+# select: index '3', range '3-7' or '3-', 'end', 'glob:<pattern>' or 're:<regex>'
+# arg: value for insert/replace, destination such as 'user:0' for move
+
+edit_actions = ('delete', 'move', 'insert', 'replace')
+edit_hives = {'u': 'user', 'user': 'user',
+              's': 'system', 'sys': 'system', 'system': 'system',
+              'b': 'both', 'both': 'both'}
+index_range = re.compile(r'^(\d+)(?:\s*-\s*(\d*))?$')
+
+
+def compile_selector(spec):
+    """Turn a selector string into a function that returns the set of
+    selected positions of a path list. Glob and regex selectors are
+    case-insensitive like Windows paths. A compiled regex is returned
+    as well, because replace uses it for substitution."""
+    spec = str(spec).strip()
+    if spec.lower().startswith('glob:'):
+        # globs match the whole entry, translate only anchors the end
+        pattern = re.compile('^' + fnmatch.translate(spec[5:]), re.IGNORECASE)
+    elif spec.lower().startswith('re:'):
+        try:
+            pattern = re.compile(spec[3:], re.IGNORECASE)
+        except re.error as e:
+            raise ValueError('invalid regex %r: %s' % (spec[3:], e))
+    elif spec.lower() == 'end':
+        return (lambda plist: {len(plist)}), None
+    else:
+        match = index_range.match(spec)
+        if not match:
+            raise ValueError('invalid selector %r, use an index, a range like '
+                             '3-7, glob:<pattern> or re:<regex>' % spec)
+        first = int(match.group(1))
+        last = match.group(2)
+        if last is None:
+            last = first
+        elif last != '':
+            last = int(last)
+            if last < first:
+                raise ValueError('invalid range %r' % spec)
+
+        def select_range(plist):
+            if last == '':
+                # open-ended ranges select nothing beyond the end, e.g. in an empty list
+                return set(range(first, len(plist)))
+            stop = last
+            if first >= len(plist) or stop >= len(plist):
+                raise ValueError('index %r out of range, the list has %i entries'
+                                 % (spec, len(plist)))
+            return set(range(first, stop + 1))
+        return select_range, None
+    return (lambda plist: {idx for idx, p in enumerate(plist) if pattern.search(p)}), pattern
+
+
+def parse_edit_op(op):
+    """Create an EditOp from a dict, a sequence or a string such as
+    'move user re:python system:0'. Quote values with spaces.
+    Values are converted to strings, e.g. numeric selectors from JSON."""
+    if isinstance(op, dict):
+        op = (op.get('action'), op.get('hive', 'both'), op.get('select'), op.get('arg'))
+    if isinstance(op, str):
+        import shlex
+        lexer = shlex.shlex(op, posix=False)
+        lexer.whitespace_split = True
+        lexer.commenters = ''
+        op = [tok[1:-1] if len(tok) > 1 and tok[0] == tok[-1] == '"' else tok
+              for tok in lexer]
+    if not 3 <= len(op) <= 4:
+        raise ValueError('expected "action hive select [arg]", got %r' % (op,))
+    return EditOp(*[v if v is None else str(v) for v in op])
+
+
+def load_edit_ops(source):
+    """Read edit operations from a JSON file (a list of dicts or strings)
+    or from a text file with one operation per line"""
+    with open(source, 'r') as f_in:
+        if source.lower().endswith('.json'):
+            return [parse_edit_op(op) for op in json.load(f_in)]
+        return [parse_edit_op(ln) for ln in f_in
+                if ln.strip() and not ln.lstrip().startswith('#')]
+
+
+Plan = namedtuple('Plan', ['ops', 'problems'])
+
+
+def exact_selector(entry):
+    return 're:^%s$' % re.escape(entry)
+
+
+def format_edit_op(op):
+    """Inverse of parse_edit_op for strings"""
+    return ' '.join('"%s"' % v if ' ' in v else v
+                    for v in (str(v) for v in op if v is not None))
+
+
+def forbidden_selector(select):
+    if select.lower().startswith(('glob:', 're:')):
+        return select
+    if any(c in select for c in '*?['):
+        return 'glob:' + select
+    return exact_selector(normpath(select, verbose=False))
+
+
+def load_policy(policy):
+    """Read a desired-state policy from a JSON file or take a dict, e.g.
+    {"required": {"user": ["C:\\tools"], "system": []},
+     "forbidden": ["glob:*\\Temp*", "re:python2\\d"],
+     "order": [["C:\\Python35", "C:\\Python27"]],
+     "max_length": 2047}
+    Forbidden entries without glob:/re: prefix are globs if they contain
+    wildcards, otherwise they forbid exactly that directory. Each order
+    pair means the first entry must come before the second in %PATH%."""
+    def strings(value):
+        return isinstance(value, (list, tuple)) and all(isinstance(v, str) for v in value)
+
+    if isinstance(policy, str):
+        with open(policy, 'r') as f_in:
+            policy = json.load(f_in)
+    if not isinstance(policy, dict):
+        raise ValueError('a policy is a JSON object')
+    unknown = set(policy) - {'required', 'forbidden', 'order', 'max_length'}
+    if unknown:
+        raise ValueError('unknown policy keys: %s' % ', '.join(sorted(unknown)))
+    required = policy.get('required', {})
+    if not isinstance(required, dict) or set(required) - {'user', 'system'}:
+        raise ValueError('required entries are given per hive: user, system')
+    for name, entries in required.items():
+        if not strings(entries):
+            raise ValueError('required %s entries must be a list of strings' % name)
+    if not strings(policy.get('forbidden', [])):
+        raise ValueError('forbidden entries must be a list of strings')
+    order = policy.get('order', [])
+    if not isinstance(order, (list, tuple)) or not all(strings(pair) and len(pair) == 2
+                                                       for pair in order):
+        raise ValueError('order constraints must be a list of pairs of strings')
+    if isinstance(policy.get('max_length', 0), bool) or \
+            not isinstance(policy.get('max_length', 0), int):
+        raise ValueError('max_length must be an integer')
+    # required entries keep their spelling, they are written to the registry like that
+    required = {name: uniquefy(required.get(name, []), key=lambda p: normpath(p, verbose=False))
+                for name in ('user', 'system')}
+    forbidden = [forbidden_selector(select) for select in policy.get('forbidden', [])]
+    for select in forbidden:
+        matches, _ = compile_selector(select)
+        for name in ('user', 'system'):
+            normalized = [normpath(p, verbose=False) for p in required[name]]
+            clash = [required[name][idx] for idx in sorted(matches(normalized))]
+            if clash:
+                raise ValueError('required entry %s is forbidden by %s' % (clash[0], select))
+    order = [tuple(normpath(p, verbose=False) for p in pair) for pair in order]
+    return dict(required=required, forbidden=forbidden, order=order,
+                max_length=policy.get('max_length', 2047))
+
+
+def as_read(read, normalized, spelling=None):
+    """Spell the normalized entries as they were read, e.g. from the
+    registry. Entries that were read several times are kept next to
+    the first one, new entries are looked up in spelling."""
+    spelling = {} if spelling is None else spelling
+    groups = OrderedDict()
+    for p in read:
+        groups.setdefault(normpath(p, verbose=False), []).append(p)
+    raw = []
+    for p in normalized:
+        raw.extend(groups.get(p) or [spelling.get(p, p)])
+    return raw
+
+
 class WinPath():
     """A tool for manipulating Windows7 USER PATH and SYSTEM PATH
     variables which are concatenated to give the PATH variable on the
@@ -84,26 +521,54 @@ class WinPath():
         >setx
     """
 
-    def __init__(self):
-        if platform.system() != 'Windows':
-            msg = stylify('warn', 'This tool is only useful on Windows systems, aborting...')
-            sys.exit(msg)
+    def __init__(self, backend=None, verbose=True, table=None):
+        if backend is None:
+            if platform.system() != 'Windows':
+                msg = stylify('warn', 'This tool is only useful on Windows systems, aborting...')
+                sys.exit(msg)
+            backend = RegistryBackend()
+        self.backend = backend
+        self.verbose = verbose
+        self.table = entry_table if table is None else table
         self.limit = 2047  # Windows 7 character limit
         self.selected = None
+        self.resolver = PathResolver()
         self.read_from_registry()
         self.check_registry_writeable()
         # https://software.intel.com/en-us/articles/limitation-to-the-length-of-the-system-path-variable
-        sys_root = os.getenv('SystemRoot')
-        self.vital_paths = self.normalize(
-            [p for p in [os.path.join(sys_root, 'system32'), sys_root]],
-            verbose=False)
+        sys_root = os.getenv('SystemRoot', 'C:\\Windows')
+        self.vital_paths = set(self.normalize(
+            [p for p in [ntpath.join(sys_root, 'system32'), sys_root]],
+            verbose=False))
 
     def read_from_registry(self):
-        self.reg_user = get_path('user', verbose=False)
-        self.reg_sys = get_path('system', verbose=False)
+        self.resolver.clear()
+        self.reg_user = self.backend.get_path('user', verbose=self.verbose)
+        self.reg_sys = self.backend.get_path('system', verbose=self.verbose)
         self.store_initial()
-        self.reg_user = self.normalize(get_path('user'), verbose=True)
-        self.reg_sys = self.normalize(get_path('system'), verbose=True)
+        self.reg_user = self.normalize(self.reg_user, verbose=self.verbose)
+        self.reg_sys = self.normalize(self.reg_sys, verbose=self.verbose)
+
+    @property
+    def reg_user(self):
+        return self._reg_user
+
+    @reg_user.setter
+    def reg_user(self, entries):
+        self._reg_user = self.hive(entries)
+
+    @property
+    def reg_sys(self):
+        return self._reg_sys
+
+    @reg_sys.setter
+    def reg_sys(self, entries):
+        self._reg_sys = self.hive(entries)
+
+    def hive(self, entries):
+        if isinstance(entries, Hive) and entries.table is self.table:
+            return entries
+        return Hive(self.table, entries)
 
     def normalize(self, path_list, verbose=True):
         return uniquefy([normpath(p, verbose=verbose) for p in path_list],
@@ -111,8 +576,8 @@ class WinPath():
 
     def store_initial(self):
         """Save initial change to check for unsaved changes"""
-        self.orig_user = self.reg_user[:]
-        self.orig_sys = self.reg_sys[:]
+        self.orig_user = self.reg_user.copy()
+        self.orig_sys = self.reg_sys.copy()
 
     @property
     def unsaved_changes(self):
@@ -121,18 +586,8 @@ class WinPath():
 
     def check_registry_writeable(self):
         """Check if the calling user has privilege to write to the registry"""
-        self.writeable_user = True
-        self.writeable_sys = True
-        try:
-            user_env = registry_open(user_key, writeable=True)
-            winreg.CloseKey(user_env)
-        except WindowsError:
-            self.writeable_user = False
-        try:
-            sys_env = registry_open(sys_key, writeable=True)
-            winreg.CloseKey(sys_env)
-        except WindowsError:
-            self.writeable_sys = False
+        self.writeable_user = self.backend.writeable('user')
+        self.writeable_sys = self.backend.writeable('system')
 
     @property
     def plist(self):
@@ -140,63 +595,87 @@ class WinPath():
         return self.reg_sys + self.reg_user
 
     def show_env_path(self):
-        print_header('PATH Variable in current environment')
         path = os.getenv('PATH')
         path_lst = path.split(';')
-        for p in path_lst:
-            print(p)
-        print('PATH has %i entries and a total length of %i chars.' %
-              (len(path_lst), len(path)))
+        lines = [header_line('PATH Variable in current environment')]
+        lines.extend(path_lst)
+        lines.append('PATH has %i entries and a total length of %i chars.' %
+                     (len(path_lst), len(path)))
+        render(lines)
 
     def show(self):
         total_len = -1  # start at -1 bcs first entry has no leading ';'
         warned = False
-        for idx, p in enumerate(self.plist):
-            total_len += 1 + len(p)  # +1 bcs of the ';'
+        lookup = self.entry_lookup()
+        lines = []
+        plist = self.plist
+        lengths = self.table.lengths
+        for idx, p in enumerate(plist):
+            total_len += 1 + lengths[plist.ids[idx]]  # +1 bcs of the ';'
             if total_len > self.limit and not warned:
-                print(stylify('warn', '/!\ Following entries will '
-                              'not be in the %%PATH%%'))
+                lines.append(stylify('warn', '/!\\ Following entries will '
+                                     'not be in the %%PATH%%'))
                 warned = True
-            print(self.format_entry(idx, p))
-        self.print_legend()
-
-    def print_legend(self):
-        print('Legend:')
-        print('S: path found in system env (HKEY_LOCAL_MACHINE\%s::Path)' % sys_key.subkey)
-        print('U: path found in user env (HKEY_CURRENT_USER\%s::PATH)' % user_key.subkey)
-        print('*: directory does not exist')
-
-    def format_entry(self, idx, entry):
+            lines.append(self.format_entry(idx, p, lookup))
+        render(lines + self.legend())
+
+    def legend(self):
+        return ['Legend:',
+                'S: path found in system env (HKEY_LOCAL_MACHINE\\%s::Path)' % sys_key.subkey,
+                'U: path found in user env (HKEY_CURRENT_USER\\%s::PATH)' % user_key.subkey,
+                '*: directory does not exist']
+
+    def entry_lookup(self):
+        """Precompute what format_entry needs, so that formatting a whole
+        listing does not search the lists and the filesystem per entry"""
+        def first_positions(plist):
+            positions = {}
+            for idx, p in enumerate(plist):
+                positions.setdefault(p, idx)
+            return positions
+        return (set(self.non_existent),
+                first_positions(self.reg_sys),
+                first_positions(self.reg_user))
+
+    def format_entry(self, idx, entry, lookup=None):
         """Format a single entry in PATH for display"""
-        nonex = entry in self.non_existent
+        if lookup is None:
+            lookup = self.entry_lookup()
+        non_existent, sys_pos, user_pos = lookup
+        nonex = entry in non_existent
         info_str = '%4i.' % idx
         info_str += [' ', '*'][nonex]
-        info_str += ['---', 'S'][entry in self.reg_sys]
-        if entry in self.reg_sys:
-            info_str += '%2i' % self.reg_sys.index(entry)
-        info_str += [' ---', ' U'][entry in self.reg_user]
-        if entry in self.reg_user:
-            info_str += '%2i' % self.reg_user.index(entry)
+        info_str += ['---', 'S'][entry in sys_pos]
+        if entry in sys_pos:
+            info_str += '%2i' % sys_pos[entry]
+        info_str += [' ---', ' U'][entry in user_pos]
+        if entry in user_pos:
+            info_str += '%2i' % user_pos[entry]
         if nonex:
             entry += ' [ N O T  F O U N D ]'
             entry = stylify('warn', entry)
         return "%s %s" % (info_str, entry)
 
     def select(self, substr):
-        print('Showing only entries containing "%s"' % substr)
         self.selected = OrderedDict()
         self.rest = OrderedDict()
-        for idx, p in enumerate(self.plist):
-            if substr.lower() in p.lower():
+        lookup = self.entry_lookup()
+        lines = ['Showing only entries containing "%s"' % substr]
+        substr = substr.casefold()
+        plist = self.plist
+        keys = plist.keys()
+        for idx, p in enumerate(plist):
+            if substr in keys[idx]:
                 self.selected[idx] = p
-                print('%s' % self.format_entry(idx, p))
+                lines.append(self.format_entry(idx, p, lookup))
             else:
                 self.rest[idx] = p
-        self.print_legend()
+        render(lines + self.legend())
         any_key()
 
     def replace_prog_files_with_junctions(self):
         created_junctions = create_junctions()
+        self.resolver.clear()
         len_user0 = len(stringify(self.reg_user))
         len_sys0 = len(stringify(self.reg_sys))
         for orig, short in created_junctions.items():
@@ -218,38 +697,178 @@ class WinPath():
         self.write()
 
     def show_registry(self):
-        def print_path(label, plist):
-            print('== ' + label + ' ==')
-            for p in plist:
-                print(p)
-        print_path('USER PATH', get_path('user'))
-        print_path('SYSTEM PATH', get_path('system'))
+        lines = ['== USER PATH ==']
+        lines.extend(self.backend.get_path('user'))
+        lines.append('== SYSTEM PATH ==')
+        lines.extend(self.backend.get_path('system'))
+        render(lines)
 
     def delete(self, to_delete=None):
-        self.reg_user = [p for p in self.reg_user if p not in to_delete]
+        table_ids = self.table.ids
+        drop = {table_ids[p] for p in to_delete if p in table_ids}
+        self.reg_user = self.reg_user.filter(lambda i: i not in drop)
         # Do not delete important entries from system path
-        to_delete = [td for td in to_delete if td.lower() not in self.vital_paths]
-        self.reg_sys = [p for p in self.reg_sys if p not in to_delete]
+        keys = self.table.keys
+        self.reg_sys = self.reg_sys.filter(
+            lambda i: i not in drop or keys[i] in self.vital_paths)
 
     def delete_ui(self, to_delete=None):
         if to_delete is None:
             print(stylify('warn', 'Call delete with an index, such as \'d 23\''))
             return
+        user_entries = set(self.reg_user.keys())
+        deletable = []
+        print()
         for del_entry in to_delete:
-            print()
-            if del_entry.lower() in self.vital_paths:
+            key = del_entry.casefold()
+            if key in self.vital_paths:
                 print('%s will not be removed from system path' % del_entry)
-                if del_entry.lower() in [p.lower() for p in self.reg_user]:
+                if key in user_entries:
                     print('But it is also contained in USER PATH')
                 else:
                     continue
             else:
                 print(del_entry)
+            deletable.append(del_entry)
+        if not deletable:
+            return
+        if len(deletable) == 1:
             print('  Delete this entry? [y]/n): ')
-            resp = input()
-            if resp.lower() in ['', 'y', 'yes']:
-                self.delete([del_entry])
-                print('Removed %s' % del_entry)
+        else:
+            print('  Delete these %i entries? [y]/n): ' % len(deletable))
+        resp = input()
+        if resp.lower() in ['', 'y', 'yes']:
+            self.delete(deletable)
+            print('Removed %i entries.' % len(deletable))
+
+    def edit(self, ops):
+        """Apply a batch of EditOps to USER PATH and SYSTEM PATH.
+        All operations are checked on copies first, if any of them fails
+        a ValueError listing all problems is raised and nothing changes.
+        Returns the vital entries that were kept in the system path."""
+        hives = {'user': self.reg_user.copy(), 'system': self.reg_sys.copy()}
+        errors = []
+        kept = []
+        for num, op in enumerate(ops, 1):
+            try:
+                op = parse_edit_op(op)
+                self._apply_edit(op, hives, kept)
+            except ValueError as e:
+                errors.append('operation %i (%s): %s' % (num, op if isinstance(op, str) else
+                                                         ' '.join(str(v) for v in op if v), e))
+        if errors:
+            raise ValueError('\n'.join(errors))
+        self.reg_user = uniquefy(hives['user'])
+        self.reg_sys = uniquefy(hives['system'])
+        return uniquefy(kept)
+
+    def _apply_edit(self, op, hives, kept=None):
+        if op.action not in edit_actions:
+            raise ValueError('unknown action, use one of %s' % ', '.join(edit_actions))
+        hive = edit_hives.get(str(op.hive).lower())
+        if hive is None:
+            raise ValueError('unknown hive, use user, system or both')
+        if op.select is None:
+            raise ValueError('nothing selected')
+        select, pattern = compile_selector(op.select)
+        if hive == 'both':
+            if pattern is None:
+                raise ValueError('index selectors need a single hive')
+            names = ['system', 'user']
+        else:
+            names = [hive]
+        if op.action in ('insert', 'replace') and not op.arg:
+            raise ValueError('%s needs a value' % op.action)
+        if op.action == 'move':
+            dest, _, position = str(op.arg or '').partition(':')
+            dest = edit_hives.get(dest.lower())
+            if dest not in ('user', 'system'):
+                raise ValueError('move needs a destination such as user:0 or system:end')
+            if position.lower() not in ('', 'end') and not position.isdigit():
+                raise ValueError('invalid move position %r' % position)
+            moved = []
+        for name in names:
+            plist = hives[name]
+            selected = select(plist)
+            if op.action == 'insert':
+                if not selected:
+                    continue
+                values = [normpath(p, verbose=False) for p in listify(op.arg)]
+                pos = min(selected)
+                plist[pos:pos] = values
+                continue
+            selected.discard(len(plist))  # 'end' selects nothing to change
+            # Vital entries stay in the system path, they can only be moved within it
+            keep = set()
+            if name == 'system' and (op.action in ('delete', 'replace') or
+                                     op.action == 'move' and dest != 'system'):
+                keys = self.table.keys
+                keep = {idx for idx in selected if keys[plist.ids[idx]] in self.vital_paths}
+                if kept is not None:
+                    kept.extend(plist[idx] for idx in sorted(keep))
+            if op.action == 'replace':
+                for idx in selected - keep:
+                    if pattern is None:
+                        new = op.arg
+                    else:
+                        new = pattern.sub(lambda match: op.arg, plist[idx])
+                    plist[idx] = normpath(new, verbose=False)
+                continue
+            if op.action == 'move':
+                moved.extend(plist[idx] for idx in sorted(selected - keep))
+            hives[name] = self.hive(p for idx, p in enumerate(plist)
+                                    if idx not in selected or idx in keep)
+        if op.action == 'move' and moved:
+            target = hives[dest]
+            moved_set = set(moved)
+            target[:] = [p for p in target if p not in moved_set]
+            if position.lower() == 'end':
+                pos = len(target)
+            else:
+                pos = min(int(position or 0), len(target))
+            target[pos:pos] = uniquefy(moved)
+
+    def edit_ui(self):
+        """Read edit operations from the console until an empty line"""
+        print('Enter one operation per line as "action hive select [value]",')
+        print('indices are positions in the path variable (S n / U n in [v]iew), e.g.')
+        print('  delete system 3-5')
+        print('  delete both glob:*\\Temp*')
+        print('  move user re:python system:0')
+        print('  insert user 0 C:\\tools')
+        print('  replace both "re:^c:\\\\program files\\\\" c:\\prg\\')
+        print('Finish with an empty line.')
+        ops = []
+        while True:
+            line = input().strip()
+            if not line:
+                break
+            ops.append(line)
+        self.edit_and_report(ops)
+
+    def move_ui(self):
+        m = InteractiveMenu()
+        hive = m.ask_input('Move from [u]ser or [s]ystem path', 'u')
+        select = m.ask_input('Entries: position in this path variable (the number after S or U '
+                             'in [v]iew), range like 3-5, glob:<pattern> or re:<regex>')
+        dest = m.ask_input('Move to [u]ser or [s]ystem path', hive)
+        position = m.ask_input('Position, 0 is the front', 'end')
+        self.edit_and_report([EditOp('move', hive, select, '%s:%s' % (dest, position))])
+
+    def edit_and_report(self, ops):
+        if not ops:
+            print('Canceled.')
+            return False
+        try:
+            kept = self.edit(ops)
+        except ValueError as e:
+            print(stylify('warn', '/!\\ Nothing changed:'))
+            print(e)
+            return False
+        for p in kept:
+            print('%s was kept in system path' % p)
+        print('Applied %i operations.' % len(ops))
+        return True
 
     def insert(self):
         print('Insert value into [u]ser or [s]ystem path: ', end='')
@@ -268,11 +887,7 @@ class WinPath():
 
     @property
     def non_existent(self):
-        nonex = []
-        for p in self.plist:
-            if not os.path.exists(p):
-                nonex.append(p)
-        return nonex
+        return [p for p in self.plist if not self.resolver.exists(p)]
 
     def purge(self):
         """Delete non-existent dirs"""
@@ -280,33 +895,87 @@ class WinPath():
         print(stylify('ok', 'Deleted all non-existent directories.'))
 
     def dedup(self):
+        """Ask what to do with entries that point to the same directory,
+        within a path variable and in both of them"""
         self.dedup_answer = ''
-        for p in self.plist:
-            if (p in self.reg_user) and (p in self.reg_sys):
-                print()
-                print(p)
-                print('  Remove from [u]ser path / [s]ystem path / [b]oth / [n]one (skip) / [c]ancel?')
-                if self.dedup_answer:
-                    answer = input(
-                        '  (enter applies previous choice: %s)' %
-                        self.dedup_answer)
-                    if answer.strip():
-                        # answer non-empty, use it
-                        self.dedup_answer = answer
-                else:
-                    self.dedup_answer = input()
-                if self.dedup_answer.lower() in ['q', 'c']:
-                    print('  Canceled')
-                    break
-                if self.dedup_answer.lower() in ['b', 'both']:
-                    self.delete([p])
-                    print('  Removed %s from user and system path.' % p)
-                if self.dedup_answer.lower() in ['u', 'user']:
-                    self.reg_user = [rup for rup in self.reg_user if rup != p]
-                    print('  Removed %s from user path.' % p)
-                if self.dedup_answer.lower() in ['s', 'sys']:
-                    self.reg_sys = [rsp for rsp in self.reg_sys if rsp != p]
-                    print('  Removed %s from system path.' % p)
+        for group in self.duplicates:
+            kept = {}
+            for hive in ('system', 'user'):
+                aliases = uniquefy([p for h, p in group if h == hive])
+                if len(aliases) > 1:
+                    keep = self.ask_alias(hive, aliases)
+                    if keep is None:
+                        print('  Canceled')
+                        return
+                    if keep:
+                        self.remove_from(hive, [p for p in aliases if p != keep])
+                        aliases = [keep]
+                if aliases:
+                    kept[hive] = aliases[0]
+            if len(kept) < 2:
+                continue
+            p_sys, p = kept['system'], kept['user']
+            print()
+            print(p)
+            if p_sys != p:
+                print('  is the same directory as %s in system path' % p_sys)
+            print('  Remove from [u]ser path / [s]ystem path / [b]oth / [n]one (skip) / [c]ancel?')
+            if self.dedup_answer:
+                answer = input(
+                    '  (enter applies previous choice: %s)' %
+                    self.dedup_answer)
+                if answer.strip():
+                    # answer non-empty, use it
+                    self.dedup_answer = answer
+            else:
+                self.dedup_answer = input()
+            if self.dedup_answer.lower() in ['q', 'c']:
+                print('  Canceled')
+                break
+            if self.dedup_answer.lower() in ['b', 'both']:
+                self.delete([p, p_sys])
+                print('  Removed %s from user and system path.' % p)
+            if self.dedup_answer.lower() in ['u', 'user']:
+                self.reg_user = [rup for rup in self.reg_user if rup != p]
+                print('  Removed %s from user path.' % p)
+            if self.dedup_answer.lower() in ['s', 'sys']:
+                self.reg_sys = [rsp for rsp in self.reg_sys if rsp != p_sys]
+                print('  Removed %s from system path.' % p_sys)
+
+    def ask_alias(self, hive, aliases):
+        """Ask which of the entries for the same directory to keep, the
+        shortest by default. Returns '' to keep all and None to cancel."""
+        shortest = min(range(len(aliases)), key=lambda idx: len(aliases[idx]))
+        print()
+        print('The same directory is listed %i times in %s path:' % (len(aliases), hive))
+        for idx, p in enumerate(aliases, 1):
+            print('  %i - %s' % (idx, p))
+        print('  Keep which one? [%i] / [a]ll (skip) / [c]ancel' % (shortest + 1))
+        answer = input().strip().lower()
+        if answer in ['q', 'c']:
+            return None
+        if answer in ['a', 'all']:
+            return ''
+        if answer == '':
+            return aliases[shortest]
+        if answer.isdigit() and 1 <= int(answer) <= len(aliases):
+            return aliases[int(answer) - 1]
+        print('  Skipped')
+        return ''
+
+    def remove_from(self, hive, entries):
+        """Remove entries from one path variable, vital entries stay in the system path"""
+        for p in entries:
+            if hive == 'system' and p.casefold() in self.vital_paths:
+                print('  %s will not be removed from system path' % p)
+            else:
+                print('  Removed %s from %s path.' % (p, hive))
+        drop = set(entries)
+        if hive == 'user':
+            self.reg_user = [p for p in self.reg_user if p not in drop]
+        else:
+            self.reg_sys = [p for p in self.reg_sys
+                            if p not in drop or p.casefold() in self.vital_paths]
 
     def backup_to_file(self, comment=''):
         path_dict = dict(USER_PATH=stringify(self.reg_user),
@@ -329,17 +998,115 @@ class WinPath():
 
     @property
     def duplicates(self):
-        return set(self.reg_user).intersection(set(self.reg_sys))
-
-    def save_to_registry(self):
-        os.system('cls')
-        set_path('user', stringify(self.reg_user))
-        set_path('system', stringify(self.reg_sys))
-        self.store_initial()
+        """Entries pointing to the same directory, as lists of (hive, entry)
+        in %PATH% order"""
+        groups = OrderedDict()
+        for hive, plist in (('system', self.reg_sys), ('user', self.reg_user)):
+            for p in plist:
+                groups.setdefault(self.resolver.identity(p), []).append((hive, p))
+        return [group for group in groups.values() if len(group) > 1]
+
+    def save_to_registry(self, clear=True):
+        """Write both path variables, returns False if one of them failed"""
+        if clear:
+            clear_screen()
+        saved = True
+        for name, plist in (('user', self.reg_user), ('system', self.reg_sys)):
+            try:
+                self.backend.set_path(name, stringify(plist))
+            except OSError as e:
+                print('Couldn\'t set %s path. Try running as administrator: ' % name)
+                print(e)
+                saved = False
+        if saved:
+            self.store_initial()
         print('To see the effect open a new cmd.exe')
+        return saved
+
+    def plan(self, policy):
+        """Compute the edit operations that make USER PATH and SYSTEM PATH
+        comply with a policy (see load_policy). The operations are checked
+        on copies, problems they cannot fix are reported in the Plan."""
+        policy = load_policy(policy)
+        hives = {'user': self.reg_user.copy(), 'system': self.reg_sys.copy()}
+        ops = []
+        problems = []
+
+        def add(op):
+            self._apply_edit(op, hives)
+            ops.append(op)
+
+        for select in policy['forbidden']:
+            matches, _ = compile_selector(select)
+            # vital entries are never deleted from the system path
+            if matches(hives['user']) or any(hives['system'][idx].lower() not in self.vital_paths
+                                             for idx in matches(hives['system'])):
+                add(EditOp('delete', 'both', select))
+        for name in ('system', 'user'):
+            present = set(hives[name])
+            missing = [p for p in policy['required'][name]
+                       if normpath(p, verbose=False) not in present]
+            if missing:
+                add(EditOp('insert', name, 'end', stringify(missing)))
+        # Each pass fixes every violated pair, more passes than pairs means a cycle
+        for _ in range(len(policy['order']) + 1):
+            violated = False
+            for first, then in policy['order']:
+                positions = {}
+                for idx, (name, p) in enumerate(
+                        [('system', p) for p in hives['system']] +
+                        [('user', p) for p in hives['user']]):
+                    if p in (first, then) and p not in positions:
+                        positions[p] = (idx, name)
+                if first in positions and then in positions and \
+                        positions[first] > positions[then]:
+                    hive = positions[first][1]
+                    if hive != positions[then][1]:
+                        # Moving entries between path variables changes who they
+                        # belong to and needs admin rights, leave that to a person
+                        problem = '%s in user path cannot come before %s in system path' % (
+                            first, then)
+                        if problem not in problems:
+                            problems.append(problem)
+                        continue
+                    violated = True
+                    add(EditOp('move', hive, exact_selector(first),
+                               '%s:%i' % (hive, hives[hive].index(then))))
+            if not violated:
+                break
+        else:
+            problems.append('ordering constraints contradict each other')
+        total_len = hives['system'].str_len + 1 + hives['user'].str_len
+        if total_len > policy['max_length']:
+            problems.append('%%PATH%% has %i chars, the policy allows %i' %
+                            (total_len, policy['max_length']))
+        return Plan(ops, problems)
+
+    def apply_policy(self, policy):
+        """Apply the plan for a policy, writing each changed hive once.
+        Entries the plan does not touch are written as they were read,
+        not normalized. Applying the same policy again changes nothing.
+        Raises OSError if a hive cannot be written."""
+        plan = self.plan(policy)
+        if plan.ops:
+            before = {'user': self.reg_user, 'system': self.reg_sys}
+            read = {'user': self.orig_user, 'system': self.orig_sys}
+            spelling = {}
+            for op in plan.ops:
+                if op.action == 'insert':
+                    spelling.update((normpath(p, verbose=False), p) for p in listify(op.arg))
+            self.edit(plan.ops)
+            after = {'user': self.reg_user, 'system': self.reg_sys}
+            for name in ('user', 'system'):
+                if after[name] != before[name]:
+                    raw = as_read(read[name], after[name], spelling)
+                    self.backend.set_path(name, stringify(raw))
+                    read[name] = raw
+            self.orig_user, self.orig_sys = self.hive(read['user']), self.hive(read['system'])
+        return plan
 
     def load_from_file(self, fname=None):
-        os.system('cls')
+        clear_screen()
         files = glob.glob('*.json')
         if fname is None:
             if files:
@@ -370,10 +1137,8 @@ class WinPath():
         print('Variables loaded.')
 
     def check_lengths(self, verbose=True):
-        user_str = stringify(self.reg_user)
-        sys_str = stringify(self.reg_sys)
-        lu = len(user_str)
-        ls = len(sys_str)
+        lu = self.reg_user.str_len
+        ls = self.reg_sys.str_len
         len_total = lu + 1 + ls
         if verbose:
             print('  USER PATH has %4i chars' % lu)
@@ -409,16 +1174,16 @@ depending on whether you use the Unicode or ANSI functions.
 """
 
 RegKey = namedtuple('RegKey', ['key', 'subkey', 'name', 'type_'])
-# type is either winreg.REG_EXPAND_SZ or winreg.REG_SZ
+# key and type are names of winreg constants, type is either REG_EXPAND_SZ or REG_SZ
 
 # Registry data for USER PATH variable
-user_key = RegKey(winreg.HKEY_CURRENT_USER,
-                  r'Environment', 'PATH', winreg.REG_SZ)
+user_key = RegKey('HKEY_CURRENT_USER',
+                  r'Environment', 'PATH', 'REG_SZ')
 
 # Registry data for SYSTEM PATH variable
-sys_key = RegKey(winreg.HKEY_LOCAL_MACHINE,
+sys_key = RegKey('HKEY_LOCAL_MACHINE',
                  r'SYSTEM\CurrentControlSet\Control\Session Manager\Environment',
-                 'Path', winreg.REG_SZ)
+                 'Path', 'REG_SZ')
 
 reg_keys = {'user': user_key,
             'system': sys_key}
@@ -429,18 +1194,18 @@ def registry_open(full_key, writeable=False):
         access = winreg.KEY_ALL_ACCESS
     else:
         access = winreg.KEY_READ
-    return winreg.OpenKey(full_key.key, full_key.subkey, 0, access)
+    return winreg.OpenKey(getattr(winreg, full_key.key), full_key.subkey, 0, access)
 
 
-def get_path(user_or_system, verbose=True):
-    """Get user or stystem path from registry"""
+def get_value(user_or_system, verbose=True):
+    """Get user or system path string and its registry type, e.g. REG_EXPAND_SZ"""
     # http://stackoverflow.com/questions/21138014/how-to-add-to-and-remove-from-systems-environment-variable-path
     if verbose:
         print('Reading %s PATH from registry...' % user_or_system.upper(), end='')
     full_key = reg_keys[user_or_system]
     open_key = registry_open(full_key)
     try:
-        path, _ = winreg.QueryValueEx(open_key, full_key.name)
+        path, type_ = winreg.QueryValueEx(open_key, full_key.name)
         winreg.CloseKey(open_key)
         if verbose:
             print('OK.')
@@ -448,25 +1213,31 @@ def get_path(user_or_system, verbose=True):
         print('Error reading value from: %s' %
               (full_key.subkey + ' - ' + full_key.name))
         print('%s' % e)
-        path = ''
-    return listify(path)
+        path, type_ = '', None
+    return path, type_
+
+
+def get_path(user_or_system, verbose=True):
+    """Get user or stystem path from registry"""
+    return listify(get_value(user_or_system, verbose=verbose)[0])
 
 
-def set_path(user_or_system, value):
-    """Write user or stystem path to registry"""
+def set_path(user_or_system, value, type_=None):
+    """Write user or stystem path to registry, type_ defaults to the
+    type in reg_keys. Raises WindowsError without write permission."""
     print('Saving %s PATH to registry ... ' % user_or_system.upper(), end='')
     full_key = reg_keys[user_or_system]
+    if type_ is None:
+        type_ = getattr(winreg, full_key.type_)
     try:
         open_key = registry_open(full_key, writeable=True)
-    except WindowsError as e:
-        print('Couldn\'t set %s path. Try running as administrator: '
-              % user_or_system)
-        print(e)
-    else:
-        winreg.SetValueEx(open_key, full_key.name, 0, full_key.type_, value)
-        winreg.CloseKey(open_key)
-        _broadcast_changes()
-        print('OK.')
+    except WindowsError:
+        print('failed.')
+        raise
+    winreg.SetValueEx(open_key, full_key.name, 0, type_, value)
+    winreg.CloseKey(open_key)
+    _broadcast_changes()
+    print('OK.')
 
 
 def _broadcast_changes():
@@ -476,6 +1247,54 @@ def _broadcast_changes():
     win32gui.SendMessage(win32con.HWND_BROADCAST, win32con.WM_SETTINGCHANGE, 0, 'Environment')
 
 
+class RegistryBackend():
+    """Reads and writes the PATH values in the Windows registry.
+    Values are written with the type they were read with, so that
+    REG_EXPAND_SZ values keep expanding e.g. %USERPROFILE%."""
+
+    def __init__(self):
+        self.types = {}
+
+    def get_path(self, user_or_system, verbose=True):
+        path, type_ = get_value(user_or_system, verbose=verbose)
+        if type_ is not None:
+            self.types[user_or_system] = type_
+        return listify(path)
+
+    def set_path(self, user_or_system, value):
+        set_path(user_or_system, value, self.types.get(user_or_system))
+
+    def writeable(self, user_or_system):
+        try:
+            winreg.CloseKey(registry_open(reg_keys[user_or_system], writeable=True))
+        except WindowsError:
+            return False
+        return True
+
+
+class MemoryBackend():
+    """Stand-in for the registry, e.g. for tests and dry runs.
+    Every write is recorded in self.writes, writing to a hive in
+    readonly raises PermissionError."""
+
+    def __init__(self, user='', system='', readonly=()):
+        self.values = {'user': user, 'system': system}
+        self.readonly = set(readonly)
+        self.writes = []
+
+    def get_path(self, user_or_system, verbose=True):
+        return listify(self.values[user_or_system])
+
+    def set_path(self, user_or_system, value):
+        if user_or_system in self.readonly:
+            raise PermissionError('%s path is read-only' % user_or_system)
+        self.values[user_or_system] = value
+        self.writes.append(user_or_system)
+
+    def writeable(self, user_or_system):
+        return user_or_system not in self.readonly
+
+
 def windows_path_gui():
     """Brings up the GUI to edit the PATH variables manually"""
     os.system('control system')
@@ -503,31 +1322,219 @@ def any_key():
 # Common paths that can be replaced by shorter junctions
 junctions = {'C:\\Program Files (x86)\\': 'C:\\prgx86\\',
              'C:\\Program Files\\': 'C:\\prg\\'}
-# Order by length from long to short, so that partial paths cannot be replaced before a full match is found
-junctions = OrderedDict(sorted(junctions.items(), key=lambda tup: len(tup[0]), reverse=True))
 
 
-def create_junctions():
-    """Junctions can be removed with rmdir"""
+def sort_junction_rules(rules):
+    """Order by length from long to short, so that partial paths cannot be replaced before a full match is found"""
+    return OrderedDict(sorted(rules.items(), key=lambda tup: len(tup[0]), reverse=True))
+
+
+junctions = sort_junction_rules(junctions)
+
+
+def load_junction_rules(fname):
+    """Read rules like the junctions above from a JSON file: {"long path": "short path"}"""
+    with open(fname, 'r') as f_in:
+        return sort_junction_rules(json.load(f_in))
+
+
+LinkResult = namedtuple('LinkResult', ['short', 'orig', 'status', 'seconds', 'error'])
+# status is one of created, exists, conflict, missing, failed (create),
+# ok, broken, gone (verify), removed, not a link, not recorded (remove)
+
+
+class JunctionLinks():
+    """NTFS junctions through the Windows API, no cmd.exe / mklink needed.
+    Junctions need no admin rights and work across local drives."""
+
+    def create(self, link, target):
+        import _winapi
+        _winapi.CreateJunction(target, link)
+
+    def is_link(self, link):
+        import stat
+        try:
+            return os.lstat(link).st_reparse_tag == stat.IO_REPARSE_TAG_MOUNT_POINT
+        except (OSError, AttributeError):
+            return False
+
+    def remove(self, link):
+        os.rmdir(link)  # removes the junction, not the directory it points to
+
+
+class SymlinkLinks():
+    """Stand-in for JunctionLinks using symbolic links, e.g. for tests on Linux"""
+
+    def create(self, link, target):
+        os.symlink(target, link, target_is_directory=True)
+
+    def is_link(self, link):
+        return os.path.islink(link)
+
+    def remove(self, link):
+        os.unlink(link)
+
+
+class JunctionManager():
+    """Creates, verifies, lists and removes the links of junction rules
+    {long path: short path}. Independent links are handled concurrently.
+    Created links are recorded in a JSON manifest, list and remove only
+    touch links recorded there."""
+
+    def __init__(self, links=None, manifest=None, workers=8):
+        if links is None:
+            links = JunctionLinks() if os.name == 'nt' else SymlinkLinks()
+        if manifest is None:
+            manifest = os.path.join(os.path.expanduser('~'), '.pywinpath_junctions.json')
+        self.links = links
+        self.manifest = manifest
+        self.workers = workers
+
+    def read_manifest(self):
+        try:
+            with open(self.manifest, 'r') as f_in:
+                return OrderedDict(json.load(f_in, object_pairs_hook=OrderedDict))
+        except FileNotFoundError:
+            return OrderedDict()
+
+    def write_manifest(self, recorded):
+        with open(self.manifest, 'w') as f_out:
+            json.dump(recorded, f_out, indent=1)
+
+    @staticmethod
+    def _key(path):
+        """Comparable form of a link path, with a trailing separator"""
+        return os.path.normcase(os.path.abspath(path.rstrip('\\/'))) + os.sep
+
+    @classmethod
+    def _batches(cls, pairs):
+        """Split (short, orig) pairs into consecutive batches of independent
+        links. A link depends on an earlier one if one of its paths is the
+        same as, inside or above one of the earlier link's paths, e.g. two
+        rules for the same short path or a short path inside another one."""
+        def related(a, b):
+            return a.startswith(b) or b.startswith(a)
+
+        batches = []
+        batch_paths = []
+        for short, orig in pairs:
+            paths = (cls._key(short), cls._key(orig))
+            # orig paths of two links may overlap, only short paths are created
+            if not batches or any(related(paths[0], other) or related(paths[1], other_short)
+                                  for other_short, other_orig in batch_paths
+                                  for other in (other_short, other_orig)):
+                batches.append([])
+                batch_paths = []
+            batches[-1].append((short, orig))
+            batch_paths.append(paths)
+        return batches
+
+    def _run(self, check, pairs, reverse=False):
+        """Run check for all (short, orig) pairs, independent links in worker
+        threads, batches of dependent links one after the other. With
+        reverse the batches run last to first, e.g. inner links are removed
+        before the links they are reached through. The results keep the
+        order of pairs."""
+        from concurrent.futures import ThreadPoolExecutor
+        if not pairs:
+            return []
+        batches = self._batches(pairs)
+        results = [None] * len(batches)
+        order = range(len(batches) - 1, -1, -1) if reverse else range(len(batches))
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for idx in order:
+                results[idx] = list(pool.map(
+                    lambda pair: self._timed(pair[0], pair[1], check), batches[idx]))
+        return [result for batch in results for result in batch]
+
+    def _timed(self, short, orig, check):
+        import time
+        start = time.perf_counter()
+        try:
+            status, error = check(short.rstrip('\\/'), orig.rstrip('\\/')), ''
+        except OSError as e:
+            status, error = 'failed', str(e)
+        return LinkResult(short, orig, status, time.perf_counter() - start, error)
+
+    def _create(self, link, target):
+        if not os.path.isdir(target):
+            return 'missing'
+        if os.path.lexists(link):
+            return 'exists' if os.path.samefile(link, target) else 'conflict'
+        self.links.create(link, target)
+        if not os.path.samefile(link, target):
+            raise OSError('%s does not point to %s' % (link, target))
+        return 'created'
+
+    def _verify(self, link, target):
+        if not self.links.is_link(link):
+            return 'gone'
+        return 'ok' if os.path.isdir(target) and os.path.samefile(link, target) else 'broken'
+
+    def _remove(self, link, target):
+        if not os.path.lexists(link):
+            return 'gone'
+        if not self.links.is_link(link):
+            return 'not a link'
+        self.links.remove(link)
+        return 'removed'
+
+    def create(self, rules):
+        """Create the links of rules, results are in the order of rules"""
+        results = self._run(self._create, [(short, orig) for orig, short in rules.items()])
+        recorded = self.read_manifest()
+        for result in results:
+            if result.status == 'created':
+                recorded[result.short] = result.orig
+        self.write_manifest(recorded)
+        return results
+
+    def verify(self):
+        """Check the links recorded in the manifest"""
+        return self._run(self._verify, list(self.read_manifest().items()))
+
+    def remove(self, shorts=None):
+        """Remove the given recorded links, all of them by default. Given
+        paths that match no recorded link are reported as not recorded."""
+        recorded = self.read_manifest()
+        if shorts is not None:
+            # spelling, case and trailing separators may differ from the manifest
+            shorts = OrderedDict((self._key(short), short) for short in shorts)
+        pairs = [(short, orig) for short, orig in recorded.items()
+                 if shorts is None or shorts.pop(self._key(short), None) is not None]
+        results = self._run(self._remove, pairs, reverse=True)
+        results += [LinkResult(short, '', 'not recorded', 0., '')
+                    for short in (shorts or {}).values()]
+        for result in results:
+            if result.status in ('removed', 'gone'):
+                del recorded[result.short]
+        self.write_manifest(recorded)
+        return results
+
+
+def format_link_result(result):
+    text = '%-10s %7.1f ms  %s -> %s' % (result.status, 1000 * result.seconds,
+                                         result.short, result.orig)
+    if result.error:
+        text += '  (%s)' % result.error
+    if result.status in ('conflict', 'failed', 'broken', 'not recorded'):
+        text = stylify('warn', text)
+    return text
+
+
+def create_junctions(rules=None, manager=None):
+    """Create junctions for rules, the common directories by default.
+    Returns the rules whose junction points to the right directory.
+    Junctions can be removed with rmdir or JunctionManager.remove"""
+    rules = junctions if rules is None else rules
+    manager = JunctionManager() if manager is None else manager
     print('Creating junctions for common directories...')
-    valid_junctions = {}
-    for orig, short in junctions.items():
-        create = True
-        if os.path.isdir(orig):
-            print('%s' % orig)
-            if os.path.isdir(short):
-                if not os.path.samefile(orig, short):
-                    print('%s and %s are not the same.' % (short, orig))
-                    continue
-                else:
-                    print(' ... %s already exists.' % short)
-                create = False
-            valid_junctions[orig] = short
-            if create:
-                cmd = r'mklink /J %s "%s"' % (short, orig)
-                print(cmd)
-                os.system(cmd)
-    return valid_junctions
+    results = manager.create(rules)
+    for result in results:
+        if result.status != 'missing':
+            print(format_link_result(result))
+    return OrderedDict((result.orig, result.short) for result in results
+                       if result.status in ('created', 'exists'))
 
 
 class InteractiveMenu():
@@ -537,7 +1544,7 @@ class InteractiveMenu():
         self.menu = OrderedDict()
 
     def cls(self):
-        os.system('cls')
+        clear_screen()
 
     def display_menu(self):
         for k, desc in self.menu.items():
@@ -555,8 +1562,6 @@ class InteractiveMenu():
 
 
 def main():
-    import re
-
     def print_help():
         print_header('HELP')
         print("It is save to try out any operations.\n",
@@ -578,7 +1583,7 @@ def main():
     d_and_index = re.compile('^d\s([\d\s]*)')
     flt_substr = re.compile('^f\s(.*)')
 
-    os.system('cls')
+    clear_screen()
     m = InteractiveMenu()
     resp = ''
     while resp.lower() != 'q':
@@ -587,6 +1592,8 @@ def main():
             wp
         except:
             wp = WinPath()
+        # resolve every entry once per menu screen to notice changed directories
+        wp.resolver.clear()
         wp.check_lengths(verbose=False)
         print('\nOptions:')
         m.menu.clear()
@@ -599,13 +1606,14 @@ def main():
             m.menu['p'] = ('Purge %i non-existent entries' % len(wp.non_existent), 'wp.purge()')
         if wp.duplicates:
             m.menu['dedup'] = (stylify(
-                'warn', '%i entries are in user AND system path' %
+                'warn', '%i directories are listed more than once' %
                 len(wp.duplicates)), 'wp.dedup()')
         m.menu['shorten'] = ('Replace common long paths by shorter ones',
                              'wp.replace_prog_files_with_junctions()')
         m.menu['d'] = ('Delete an entry, e.g. "d 22 23" deletes 22nd and 23rd entry of [v]iew listing', 'wp.delete_ui()')
         m.menu['a'] = ('Add an entry', 'wp.insert()')
-        # m.menu['m'] = ('Move an entry', 'print("not implemented yet")')
+        m.menu['m'] = ('Move entries within or between user and system path', 'wp.move_ui()')
+        m.menu['e'] = ('Batch edit: delete/move/insert/replace by index, glob or regex', 'wp.edit_ui()')
         m.menu['r'] = ('Display path info currently in registry', 'wp.show_registry()')
         m.menu['env'] = ('Display %PATH% of current environment', 'wp.show_env_path()')
         # m.menu['w'] = ('Write path strings to file', 'wp.write()')
@@ -644,8 +1652,83 @@ def main():
             print("Unknown command '%s', please select one of the options." % resp)
 
 
+def cli(argv=None):
+    """Command line interface, without arguments the interactive menu starts"""
+    import argparse
+    parser = argparse.ArgumentParser(prog='pywinpath', description=__doc__)
+    commands = parser.add_subparsers(dest='command')
+    edit_parser = commands.add_parser(
+        'edit', help='apply edit operations to USER PATH and SYSTEM PATH')
+    edit_parser.add_argument(
+        'ops', nargs='+',
+        help='operations like "delete system 3-5" or files with one operation per '
+             'line, JSON files contain a list of operations')
+    edit_parser.add_argument('--save', action='store_true',
+                             help='write the result to the registry')
+    for command, help_text in [('plan', 'show the edits needed to comply with a policy'),
+                               ('apply', 'apply the edits needed to comply with a policy')]:
+        policy_parser = commands.add_parser(command, help=help_text)
+        policy_parser.add_argument('policy', help='JSON policy file')
+    link_parser = commands.add_parser(
+        'junctions', help='create, list or remove junctions for shorter paths')
+    link_parser.add_argument('action', choices=['create', 'list', 'remove'])
+    link_parser.add_argument('shorts', nargs='*', help='links to remove, default: all')
+    link_parser.add_argument('--rules', help='JSON file {"long path": "short path"}')
+    link_parser.add_argument('--manifest', help='JSON file recording the created links')
+    args = parser.parse_args(argv)
+    if args.command is None:
+        main()
+        return
+    if args.command == 'junctions':
+        manager = JunctionManager(manifest=args.manifest)
+        if args.action == 'create':
+            rules = junctions if args.rules is None else load_junction_rules(args.rules)
+            results = manager.create(rules)
+        elif args.action == 'list':
+            results = manager.verify()
+        else:
+            results = manager.remove(args.shorts or None)
+        for result in results:
+            print(format_link_result(result))
+        if not results:
+            print('No junctions.')
+        failed = ('conflict', 'failed', 'broken', 'not recorded')
+        sys.exit(1 if any(r.status in failed for r in results) else 0)
+    if args.command in ('plan', 'apply'):
+        try:
+            policy = load_policy(args.policy)
+        except (ValueError, OSError) as e:
+            sys.exit(stylify('warn', 'Invalid policy: %s' % e))
+        wp = WinPath(verbose=False)
+        try:
+            if args.command == 'plan':
+                plan = wp.plan(policy)
+            else:
+                plan = wp.apply_policy(policy)
+        except OSError as e:
+            print(stylify('warn', 'Couldn\'t write the PATH: %s' % e))
+            sys.exit(3)
+        for op in plan.ops:
+            print(format_edit_op(op))
+        for problem in plan.problems:
+            print(stylify('warn', '/!\\ %s' % problem))
+        if not plan.ops:
+            print('Nothing to do.')
+        sys.exit(1 if plan.problems else 0)
+    wp = WinPath()
+    if args.command == 'edit':
+        ops = []
+        for op in args.ops:
+            ops.extend(load_edit_ops(op) if os.path.isfile(op) else [op])
+        if not wp.edit_and_report(ops):
+            sys.exit(2)
+        wp.check_lengths(verbose=False)
+        if args.save and wp.unsaved_changes and not wp.save_to_registry(clear=False):
+            sys.exit(3)
+
+
 if __name__ == '__main__':
     try:
-        main()
+        cli()
     except KeyboardInterrupt:
         sys.exit(1)
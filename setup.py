@@ -27,7 +27,7 @@ setup_params = dict(
     py_modules=['pywinpath'],
     entry_points={
         'console_scripts': [
-            'pywinpath = pywinpath:main',
+            'pywinpath = pywinpath:cli',
         ]
     },
     include_package_data=True,
@@ -1,10 +1,15 @@
 # run with    py.test -sv
+import io
+import os
 import unittest
 from unittest.mock import patch  # mock is new in python 3.3
 
+from collections import OrderedDict
+
 from pywinpath import *
 
 
+@unittest.skipUnless(platform.system() == 'Windows', 'needs the Windows registry')
 class TestPyWinPath(unittest.TestCase):
 
     @patch('builtins.input', lambda: 'q')
@@ -67,6 +72,404 @@ class TestPyWinPath(unittest.TestCase):
         self.assertEqual(len(wp.plist), 2)
 
 
+class TestBatchEdit(unittest.TestCase):
+
+    def test_batch_edit(self):
+        wp = WinPath(backend=MemoryBackend(), verbose=False)
+        wp.reg_user = listify('C:\\a;C:\\b;C:\\Program Files\\x')
+        wp.reg_sys = listify('C:\\Windows;C:\\s1;C:\\s2')
+        wp.edit(['delete system 0-',
+                 'move user glob:*\\[ab] system:end',
+                 EditOp('replace', 'both', 're:^c:\\\\program files\\\\', 'C:\\prg\\'),
+                 EditOp('insert', 'user', '0', 'C:\\tools')])
+        # vital entries are kept in the system path
+        self.assertEqual(wp.reg_sys, ['C:\\Windows', 'C:\\a', 'C:\\b'])
+        self.assertEqual(wp.reg_user, ['c:\\tools', 'c:\\prg\\x'])
+
+    def test_batch_edit_is_validated_first(self):
+        wp = WinPath(backend=MemoryBackend(), verbose=False)
+        wp.reg_user = listify('p1;p2')
+        wp.reg_sys = listify('p3')
+        user, system = wp.reg_user[:], wp.reg_sys[:]
+        with self.assertRaises(ValueError) as cm:
+            wp.edit(['delete user 0', 'delete user 5', 'move user re:( system:0'])
+        self.assertIn('operation 2', str(cm.exception))
+        self.assertIn('operation 3', str(cm.exception))
+        self.assertEqual((wp.reg_user, wp.reg_sys), (user, system))
+
+    def test_replace_keeps_vital_entries(self):
+        wp = WinPath(backend=MemoryBackend(), verbose=False)
+        for op in ['replace system re:windows foo', 'replace system 0-1 C:\\x']:
+            wp.reg_sys = listify('C:\\Windows;C:\\Windows\\system32')
+            wp.edit([op])
+            self.assertEqual(wp.reg_sys, ['C:\\Windows', 'C:\\Windows\\system32'])
+
+    def test_move_keeps_vital_entries(self):
+        wp = WinPath(backend=MemoryBackend(), verbose=False)
+        wp.reg_user = listify('C:\\a')
+        wp.reg_sys = listify('C:\\Windows;C:\\s')
+        self.assertEqual(wp.edit(['move system 0-1 user:0']), ['C:\\Windows'])
+        self.assertEqual(wp.reg_sys, ['C:\\Windows'])
+        self.assertEqual(wp.reg_user, ['C:\\s', 'C:\\a'])
+        # within the system path vital entries can be moved
+        wp.reg_sys = listify('C:\\s;C:\\Windows')
+        self.assertEqual(wp.edit(['move system 1 system:0']), [])
+        self.assertEqual(wp.reg_sys, ['C:\\Windows', 'C:\\s'])
+
+    def test_cli_save_failure(self):
+        backend = MemoryBackend(user='C:\\a;C:\\b', readonly=['user', 'system'])
+        with patch('pywinpath.WinPath', lambda: WinPath(backend=backend, verbose=False)), \
+                patch('pywinpath.clear_screen') as clear, patch('sys.stdout', io.StringIO()):
+            with self.assertRaises(SystemExit) as cm:
+                cli(['edit', 'delete user 0', '--save'])
+        self.assertEqual(cm.exception.code, 3)
+        clear.assert_not_called()
+
+    def test_glob_matches_whole_entry(self):
+        wp = WinPath(backend=MemoryBackend(), verbose=False)
+        wp.reg_user = listify('bin;C:\\tools\\bin;C:\\mytemp\\x;temp1')
+        wp.reg_sys = []
+        wp.edit(['delete user glob:bin', 'delete user glob:temp*'])
+        self.assertEqual(wp.reg_user, ['C:\\tools\\bin', 'C:\\mytemp\\x'])
+
+    def test_json_and_empty_selections(self):
+        wp = WinPath(backend=MemoryBackend(), verbose=False)
+        wp.reg_user = listify('C:\\a;C:\\b')
+        wp.reg_sys = []
+        wp.edit([{'action': 'delete', 'hive': 'user', 'select': 0},
+                 'delete system 0-'])
+        self.assertEqual(wp.reg_user, ['C:\\b'])
+        with self.assertRaises(ValueError):
+            wp.edit([{'action': 'delete', 'hive': 'user', 'select': 3}])
+
+
+class TestDuplicates(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.prog = os.path.join(self.tmp.name, 'Program Files')
+        os.makedirs(os.path.join(self.prog, 'foo'))
+        self.short = os.path.join(self.tmp.name, 'prg')
+        try:
+            os.symlink(self.prog, self.short, target_is_directory=True)
+        except (OSError, NotImplementedError):
+            self.skipTest('no privilege to create symlinks')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_same_directory(self):
+        patcher = patch.dict('os.environ', {'PYWINPATH_TEST': self.prog})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        wp = WinPath(backend=MemoryBackend(), verbose=False)
+        wp.reg_sys = [os.path.join(self.prog, 'foo') + os.sep, 'missing']
+        wp.reg_user = [os.path.join(self.short, 'foo'), os.path.join('%pywinpath_test%', 'foo'),
+                       'missing']
+        self.assertEqual([len(group) for group in wp.duplicates], [3, 2])
+        self.assertEqual(wp.non_existent, ['missing', 'missing'])
+        # the shorter alias is the default, cancel keeps everything else
+        answers = iter(['', 'c'])
+        with patch('builtins.input', lambda *args: next(answers)):
+            wp.dedup()
+        self.assertEqual(wp.reg_user, [os.path.join('%pywinpath_test%', 'foo'), 'missing'])
+        self.assertEqual([len(group) for group in wp.duplicates], [2, 2])
+        answers = iter(['u', 'u'])
+        with patch('builtins.input', lambda *args: next(answers)):
+            wp.dedup()
+        self.assertEqual(wp.duplicates, [])
+        self.assertEqual(wp.reg_user, [])
+        self.assertEqual(len(wp.reg_sys), 2)
+
+    def test_cancel_before_any_change(self):
+        wp = WinPath(backend=MemoryBackend(), verbose=False)
+        wp.reg_user = [os.path.join(self.prog, 'foo'), os.path.join(self.short, 'foo')]
+        with patch('builtins.input', lambda *args: 'c'):
+            wp.dedup()
+        self.assertEqual(len(wp.reg_user), 2)
+
+    def test_environment_read_once(self):
+        resolver = PathResolver()
+        with patch.dict('os.environ', {'PYWINPATH_TEST': self.prog}):
+            self.assertEqual(resolver.expand('%pywinpath_test%'), self.prog)
+            environ = resolver.environ
+            resolver.expand('%PyWinPath_Test%\\foo')
+            self.assertIs(resolver.environ, environ)
+            resolver.clear()
+            self.assertIsNone(resolver.environ)
+
+    def test_resolved_once(self):
+        resolver = PathResolver()
+        with patch('os.stat', side_effect=os.stat) as stat:
+            for _ in range(3):
+                resolver.identity(self.short)
+        self.assertEqual(stat.call_count, 1)
+
+
+class TestCompactEntries(unittest.TestCase):
+
+    def test_hive_is_a_list_of_interned_entries(self):
+        table = EntryTable()
+        user = Hive(table, ['C:\\a', 'C:\\b'])
+        system = Hive(table, ['C:\\b', 'C:\\c'])
+        self.assertEqual(len(table), 3)
+        self.assertIs(user[1], system[0])
+        self.assertEqual(user, ['C:\\a', 'C:\\b'])
+        self.assertEqual(user.keys(), ['c:\\a', 'c:\\b'])
+        self.assertEqual(user.str_len, len('C:\\a;C:\\b'))
+        plist = system + user
+        self.assertIsInstance(plist, Hive)
+        self.assertEqual(plist.index('C:\\a'), 2)
+        plist[1:1] = ['C:\\d']
+        plist.insert(0, 'C:\\e')
+        del plist[-1]
+        self.assertEqual(list(plist), ['C:\\e', 'C:\\b', 'C:\\d', 'C:\\c', 'C:\\a'])
+        self.assertNotIn('C:\\x', plist)
+        self.assertEqual(len(table), 5)
+
+    def test_snapshots_share_the_table(self):
+        table = EntryTable()
+        snapshots = [WinPath(backend=MemoryBackend(user='C:\\a;C:\\b', system='C:\\c'),
+                             verbose=False, table=table) for _ in range(3)]
+        self.assertEqual(len(table), 6)  # as read and normalized
+        self.assertEqual(snapshots[0].reg_user, snapshots[2].reg_user)
+        snapshots[1].store_initial()
+        self.assertFalse(snapshots[1].unsaved_changes)
+        snapshots[1].delete(['c:\\a'])
+        self.assertEqual(snapshots[1].reg_user, ['c:\\b'])
+        self.assertTrue(snapshots[1].unsaved_changes)
+
+
+class TestJunctions(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.manager = JunctionManager(links=SymlinkLinks(),
+                                       manifest=os.path.join(self.tmp.name, 'links.json'))
+        self.rules = OrderedDict()
+        for name in range(12):
+            orig = os.path.join(self.tmp.name, 'long name %i' % name)
+            os.mkdir(orig)
+            self.rules[orig + os.sep] = os.path.join(self.tmp.name, 'l%i' % name) + os.sep
+        self.rules[os.path.join(self.tmp.name, 'missing')] = os.path.join(self.tmp.name, 'm')
+        os.mkdir(os.path.join(self.tmp.name, 'l11'))  # not a link to 'long name 11'
+        try:
+            os.symlink(self.tmp.name, os.path.join(self.tmp.name, 'probe'))
+        except (OSError, NotImplementedError):
+            self.skipTest('no privilege to create symlinks')
+
+    def statuses(self, results):
+        return [result.status for result in results]
+
+    def test_create_verify_remove(self):
+        results = self.manager.create(self.rules)
+        self.assertEqual(self.statuses(results), ['created'] * 11 + ['conflict', 'missing'])
+        self.assertEqual([r.short for r in results], list(self.rules.values()))
+        self.assertTrue(all(r.seconds >= 0 for r in results))
+        self.assertEqual(self.statuses(self.manager.create(self.rules))[:11], ['exists'] * 11)
+        self.assertEqual(self.statuses(self.manager.verify()), ['ok'] * 11)
+        short = results[0].short
+        self.assertEqual(self.statuses(self.manager.remove([short])), ['removed'])
+        self.assertEqual(len(self.manager.verify()), 10)
+        self.assertEqual(self.statuses(self.manager.remove()), ['removed'] * 10)
+        self.assertEqual(self.manager.verify(), [])
+        # the directories the links pointed to are still there
+        self.assertTrue(all(os.path.isdir(orig) for orig in list(self.rules)[:12]))
+
+    def test_remove_by_other_spelling(self):
+        rules = OrderedDict(list(self.rules.items())[:2])
+        first, second = [r.short for r in self.manager.create(rules)]
+        unknown = os.path.join(self.tmp.name, 'unknown')
+        results = self.manager.remove([first.rstrip(os.sep), unknown])
+        self.assertEqual(self.statuses(results), ['removed', 'not recorded'])
+        self.assertEqual(results[1].short, unknown)
+        self.assertFalse(os.path.lexists(first.rstrip(os.sep)))
+        self.assertEqual([r.short for r in self.manager.verify()], [second])
+
+    def test_dependent_links(self):
+        origs = list(self.rules)
+        outer = os.path.join(self.tmp.name, 's')
+        inner = os.path.join(outer, 'inner')
+        rules = OrderedDict([(origs[0], outer), (origs[1], outer), (origs[2], inner)])
+        pairs = [(short, orig) for orig, short in rules.items()]
+        self.assertEqual([len(batch) for batch in JunctionManager._batches(pairs)], [1, 1, 1])
+        independent = [(short, orig) for orig, short in self.rules.items()]
+        self.assertEqual(len(JunctionManager._batches(independent)), 1)
+        for _ in range(20):
+            results = self.manager.create(rules)
+            self.assertEqual(self.statuses(results)[:2], ['created', 'conflict'])
+            # the inner link is created inside the directory of the outer one
+            self.assertEqual(self.statuses(results)[2], 'created')
+            self.assertTrue(os.path.islink(os.path.join(origs[0], 'inner')))
+            self.assertEqual(self.statuses(self.manager.remove()), ['removed', 'removed'])
+            self.assertFalse(os.path.lexists(os.path.join(origs[0], 'inner')))
+
+    def test_create_junctions(self):
+        with patch('sys.stdout', io.StringIO()):
+            valid = create_junctions(self.rules, self.manager)
+        self.assertEqual(list(valid), list(self.rules)[:11])
+
+
+class TestRendering(unittest.TestCase):
+
+    def test_render_without_tty(self):
+        out = io.StringIO()
+        with patch('sys.stdout', out), patch('pywinpath.msvcrt') as msvcrt:
+            render(['line %i' % i for i in range(5000)])
+            clear_screen()
+        msvcrt.getch.assert_not_called()
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 5000)
+        self.assertEqual(lines[-1], 'line 4999')
+
+    class Console(io.StringIO):
+        """Interactive console that counts write calls"""
+        writes = 0
+
+        def isatty(self):
+            return True
+
+        def write(self, text):
+            self.writes += 1
+            return super().write(text)
+
+    def render_paged(self, keys, n_lines=25):
+        out = self.Console()
+        with patch('sys.stdout', out), \
+                patch('pywinpath.shutil.get_terminal_size', lambda: os.terminal_size((80, 11))), \
+                patch('pywinpath.msvcrt') as msvcrt:
+            msvcrt.getch.side_effect = keys
+            render(['line %i' % i for i in range(n_lines)])
+        return out, msvcrt.getch.call_count
+
+    def test_render_one_write_per_page(self):
+        out, n_keys = self.render_paged([b' ', b' '])
+        self.assertEqual(n_keys, 2)
+        self.assertEqual(out.writes, 3)
+        self.assertIn('line 24', out.getvalue())
+
+    def test_render_quit_paging(self):
+        out, n_keys = self.render_paged([b'q'])
+        self.assertEqual(n_keys, 1)
+        self.assertEqual(out.writes, 2)  # first page with prompt, erasing the prompt
+        self.assertIn('line 9\n', out.getvalue())
+        self.assertNotIn('line 10', out.getvalue())
+
+    def test_show_is_rendered_at_once(self):
+        wp = WinPath(backend=MemoryBackend(
+            user=stringify(['C:\\user%i' % i for i in range(300)]),
+            system='C:\\sys1;C:\\user1'), verbose=False)
+        out = self.Console()
+        out.isatty = lambda: False
+        with patch('sys.stdout', out):
+            wp.show()
+        self.assertEqual(out.writes, 1)
+        lines = out.getvalue().splitlines()
+        self.assertIn('S 1 U 1 c:\\user1', lines[1])
+        self.assertEqual(lines[-4], 'Legend:')
+
+
+class TestPolicy(unittest.TestCase):
+    policy = {'required': {'user': ['C:\\tools'], 'system': ['C:\\s1']},
+              'forbidden': ['*\\temp\\*', 're:^c:\\\\windows$'],
+              'order': [['C:\\Python35', 'C:\\Python27'], ['C:\\tools', 'C:\\a']],
+              'max_length': 2047}
+
+    def backend(self):
+        return MemoryBackend(user='C:\\a;C:\\Temp\\x;C:\\Python27;C:\\Python35;',
+                             system='C:\\Windows;C:\\Windows\\system32;C:\\s1')
+
+    def test_plan(self):
+        wp = WinPath(backend=self.backend(), verbose=False)
+        plan = wp.plan(self.policy)
+        self.assertEqual([op.action for op in plan.ops], ['delete', 'insert', 'move', 'move'])
+        self.assertEqual(plan.problems, [])
+        for op in plan.ops:
+            self.assertEqual(parse_edit_op(format_edit_op(op)), op)
+
+    def test_apply_is_idempotent(self):
+        backend = self.backend()
+        WinPath(backend=backend, verbose=False).apply_policy(self.policy)
+        # vital system entries survive, the unchanged system path is not written
+        self.assertEqual(backend.writes, ['user'])
+        # entries are written as they were read
+        self.assertEqual(listify(backend.values['user']),
+                         ['C:\\tools', 'C:\\a', 'C:\\Python35', 'C:\\Python27'])
+        plan = WinPath(backend=backend, verbose=False).apply_policy(self.policy)
+        self.assertEqual(plan.ops, [])
+        self.assertEqual(backend.writes, ['user'])
+
+    def test_apply_only_changes_planned_entries(self):
+        user = 'relative\\x;%USERPROFILE%\\bin;C:\\Foo;C:\\b;C:\\foo'
+        backend = MemoryBackend(user=user)
+        WinPath(backend=backend, verbose=False).apply_policy(
+            {'required': {'user': ['C:\\Tools']}})
+        # string duplicates are kept, next to the first one
+        self.assertEqual(backend.values['user'],
+                         'relative\\x;%USERPROFILE%\\bin;C:\\Foo;C:\\foo;C:\\b;C:\\Tools')
+
+    def test_write_failure(self):
+        backend = MemoryBackend(user='C:\\a', system='C:\\s', readonly=['system'])
+        wp = WinPath(backend=backend, verbose=False)
+        with self.assertRaises(OSError):
+            wp.apply_policy({'required': {'system': ['C:\\tools']}})
+        self.assertEqual(backend.writes, [])
+
+    def test_bare_forbidden_path_is_exact(self):
+        backend = MemoryBackend(user='C:\\tools\\bin;C:\\bin;C:\\Tools\\Bin\\')
+        plan = WinPath(backend=backend, verbose=False).apply_policy(
+            {'forbidden': ['bin', 'C:\\tools\\bin']})
+        self.assertEqual(len(plan.ops), 1)
+        self.assertEqual(backend.values['user'], 'C:\\bin')
+
+    def test_order_between_path_variables(self):
+        policy = {'required': {'user': ['C:\\tools']}, 'order': [['C:\\tools', 'C:\\b']]}
+        backend = MemoryBackend(user='C:\\a', system='C:\\b')
+        for _ in range(2):
+            plan = WinPath(backend=backend, verbose=False).apply_policy(policy)
+            self.assertEqual(plan.problems, ['c:\\tools in user path cannot come before '
+                                             'c:\\b in system path'])
+        self.assertEqual(plan.ops, [])
+        self.assertEqual(backend.values, {'user': 'C:\\a;C:\\tools', 'system': 'C:\\b'})
+        self.assertEqual(backend.writes, ['user'])
+
+    def test_problems(self):
+        policy = dict(self.policy, max_length=10,
+                      order=[['C:\\a', 'C:\\b'], ['C:\\b', 'C:\\a']])
+        wp = WinPath(backend=MemoryBackend(user='C:\\b;C:\\a'), verbose=False)
+        plan = wp.plan(policy)
+        self.assertEqual(len(plan.problems), 2)
+        with self.assertRaises(ValueError):
+            load_policy({'required': {'user': ['C:\\Temp\\y']}, 'forbidden': ['*\\temp\\*']})
+
+    def test_cli_missing_policy(self):
+        out = io.StringIO()
+        with patch('pywinpath.WinPath', lambda verbose: WinPath(backend=MemoryBackend())), \
+                patch('sys.stdout', out):
+            with self.assertRaises(SystemExit) as cm:
+                cli(['plan', os.path.join(os.path.dirname(__file__), 'nope.json')])
+        self.assertIn('Invalid policy', str(cm.exception.code))
+        self.assertNotIn('write', out.getvalue())
+
+    def test_policy_types(self):
+        for policy in [{'required': {'user': 'C:\\tools'}},
+                       {'required': ['C:\\tools']},
+                       {'forbidden': 'C:\\tools'},
+                       {'forbidden': [1]},
+                       {'order': [['C:\\a', 'C:\\b', 'C:\\c']]},
+                       {'order': ['ab']},
+                       {'max_length': '2047'},
+                       ['C:\\tools']]:
+            with self.assertRaises(ValueError):
+                load_policy(policy)
+        # a loaded policy can be loaded again
+        policy = load_policy(self.policy)
+        self.assertEqual(load_policy(policy), policy)
+
+
 class TestRegistryWrites(unittest.TestCase):
     @unittest.skip("skipping because it would change local registry temporarily")
     def test_set_user_path_in_registry(self):